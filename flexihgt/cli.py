@@ -1,9 +1,36 @@
-import argparse
 import sys
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import os
 import time
-from .core import HGTDetect
+from pathlib import Path
+import numpy as np
+from .core import HGTDetect, set_shared_taxonomy
+
+# Read-only taxonomy data shared with worker processes. The tax_level
+# array lives in shared memory so workers attach to it instead of each
+# receiving a pickled copy; the smaller lookup structures go through the
+# pool initializer once per worker
+_names = None
+_shm = None
+
+def _worker_init(shm_name, n_taxids, taxid_to_idx, species_of, names):
+    """
+    Attaches to the shared tax_level array and installs the taxonomy
+    lookup structures for this worker
+    """
+    global _names, _shm
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    level_of = np.ndarray((n_taxids,), dtype=np.int64, buffer=_shm.buf)
+    set_shared_taxonomy(taxid_to_idx, level_of, species_of)
+    _names = names
+
+def _process_gene_wrapper(task):
+    """
+    Unpacks a per-gene task and runs process_gene with the shared taxonomy data
+    """
+    gene, hits, args, host_taxlevel = task
+    return HGTDetect.process_gene(gene, hits, args, _names, host_taxlevel)
 
 def noargs(args):
     """
@@ -19,23 +46,38 @@ def main():
     """
     Runs main pipeline
     """
+    args = HGTDetect.parse_args()
     hgt = HGTDetect()
-    args = hgt.parse_args()
-    #hgt.set_params(args)
+    hgt.set_params(args)
     host_taxlevel = hgt.get_refTax(args.query_tax, args.tax_level)
-    genes = hgt.load_fasta(args.input_file, hgt.genes, hgt.geneSeq)
-    hgt.run_search(args.input_file)
-    combined_file = f"{os.path.splitext(args.input_file)[0]}.tsv"
-    taxonomy_alignments, ranks, names = hgt.fetch_all_taxonomy_data(combined_file, args.query_tax)
-    with ThreadPoolExecutor() as executor:
-        results = list(executor.map(lambda gene: hgt.process_gene(gene,
-                                    combined_file, args, taxonomy_alignments,
-                                    ranks, names, host_taxlevel), genes))
-    results = [r for r in results if r is not None]
-    hgt.write_output(results, args.tax_level)
+    genes = hgt.load_fasta(args.input_file, hgt.genes)
+    # Compute the results path once; run_search and every later read share it
+    combined_file = Path(args.input_file).with_suffix('.tsv')
+    hgt.run_search(args.input_file, combined_file)
+    gene_hits = hgt.load_all_diamond_results(combined_file)
+    taxid_to_idx, level_of, species_of, names = hgt.fetch_all_taxonomy_data(combined_file, args.query_tax, gene_hits)
+    tasks = [(gene, gene_hits.get(gene), args, host_taxlevel) for gene in genes]
+    # sched_getaffinity respects cgroup CPU limits inside containers, unlike
+    # os.cpu_count(); larger chunks cut per-task IPC overhead
+    nworkers = len(os.sched_getaffinity(0))
+    shm = shared_memory.SharedMemory(create=True, size=max(level_of.nbytes, 1))
+    try:
+        shm_view = np.ndarray(level_of.shape, dtype=level_of.dtype, buffer=shm.buf)
+        shm_view[:] = level_of
+        with ProcessPoolExecutor(max_workers=nworkers, initializer=_worker_init,
+                                 initargs=(shm.name, len(level_of), taxid_to_idx,
+                                           species_of, names)) as executor:
+            # executor.map is consumed lazily so rows are written as genes
+            # finish instead of materializing the full result list first
+            results = executor.map(_process_gene_wrapper, tasks,
+                                   chunksize=max(1, len(genes) // (nworkers * 8)))
+            hgt.write_output(results, args.tax_level)
+    finally:
+        shm.close()
+        shm.unlink()
 
 if __name__ == "__main__":
-    noargs(sys.argv)
+    noargs(sys.argv[1:])
     start_time = time.time()
     main()
     end_time = time.time()
@@ -1,11 +1,74 @@
 #!/usr/bin/env python3
-import sys, os, warnings, math, csv, argparse, time
+import sys, os, warnings, math, csv, argparse, time, pickle
+import subprocess, shlex, threading, sqlite3
+from pathlib import Path
+from collections import defaultdict
+from functools import lru_cache
+from operator import itemgetter
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor
 from ete3 import NCBITaxa
 from typing import List, Dict, Tuple, Set, Any
-from functools import lru_cache
 import pandas as pd
-from Bio import SeqIO, BiopythonWarning
+from Bio import BiopythonWarning
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
+# Shared read-only taxonomy structures, set once per process (or per pool
+# worker) via set_shared_taxonomy so the cached classification below only
+# takes hashable arguments
+_taxid_to_idx: Dict[str, int] = {}
+_level_of = None
+_species_of: List[str] = []
+
+def set_shared_taxonomy(taxid_to_idx: Dict[str, int], level_of: 'np.ndarray', species_of: List[str]) -> None:
+    """
+    Installs the flattened taxonomy arrays for this process
+    """
+    global _taxid_to_idx, _level_of, _species_of
+    _taxid_to_idx = taxid_to_idx
+    _level_of = level_of
+    _species_of = species_of
+    _classify_hits.cache_clear()
+
+@lru_cache(maxsize=200_000)
+def _classify_hits(gene_taxlevel: int, hits_tuple: Tuple[Tuple[str, float], ...]) -> Tuple[float, float, int, int, Any, int]:
+    """
+    Classifies a hashable summary of a gene's hits against the query
+    tax level. Genes from the same family often share identical hit sets,
+    so the result is memoized on (tax level, hit summary)
+    """
+    recipient_bitscores: List[float] = []
+    outgroup_bitscores: List[Tuple[float, str]] = []
+    recipient_species = set()
+    outgroup_species = set()
+    missing_taxids = 0
+    for taxid, bitscore in hits_tuple:
+        idx = _taxid_to_idx.get(taxid)
+        if idx is None:
+            missing_taxids += 1
+            continue
+        if _level_of[idx] == gene_taxlevel:
+            recipient_bitscores.append(bitscore)
+            recipient_species.add(_species_of[idx])
+        else:
+            outgroup_bitscores.append((bitscore, taxid))
+            outgroup_species.add(_species_of[idx])
+    max_recipient_bitscore = max(recipient_bitscores) if recipient_bitscores else 0
+    # One pass over the outgroup hits yields both the top bitscore and
+    # the donor taxid it belongs to
+    if outgroup_bitscores:
+        max_outgroup_bitscore, donor_taxid = max(outgroup_bitscores, key=itemgetter(0))
+    else:
+        max_outgroup_bitscore, donor_taxid = 0, None
+    return (max_recipient_bitscore, max_outgroup_bitscore, len(recipient_species),
+            len(outgroup_species), donor_taxid, missing_taxids)
 
 class HGTDetect:
     """
@@ -23,15 +86,13 @@ class HGTDetect:
         self.search = "diamond"
         self.query_tax = None
         self.genes: List[str] = []
-        self.geneSeq: Dict[str, str] = {}
         self.HGT: List[List[Any]] = []
-        self.set_params(self.parse_args())
         #self.ncbi.update_taxonomy_database()
-        #self.taxdb = "~/.etetoolkit/taxa.sqlite"
         self.taxdb = "~/.etetoolkit/taxa.sqlite"
         self.dmnd_dbpath = None
 
-    def parse_args(self) -> Any:
+    @staticmethod
+    def parse_args() -> Any:
         """
         Parses command line arguments
         """
@@ -82,50 +143,94 @@ class HGTDetect:
         print(f"{'Search Method':<20} | {search}")
         print("-----------------")
 
-    def load_fasta(self, name: str , genes: List[str], geneSeq: Dict[str, str]) -> List[str]:
+    def load_fasta(self, name: str , genes: List[str]) -> List[str]:
         """
-        Loads the fasta file into a dictionary
+        Loads the gene identifiers from the fasta file
         """
-        with open(name, 'r') as handleGene:
-            for record in SeqIO.parse(handleGene, "fasta"):
-                gene = str(record.id)
-                sequence = str(record.seq)
-                geneSeq[gene] = sequence
-                genes.append(gene)
+        # SimpleFastaParser yields plain (title, sequence) tuples, skipping the
+        # per-record SeqRecord allocation SeqIO.parse would do. Only the
+        # identifiers are consumed downstream, so the sequences are not kept
+        with open(name, 'r', buffering=1 << 20) as handleGene:
+            for title, _ in SimpleFastaParser(handleGene):
+                genes.append(title.split(None, 1)[0])
         return genes
 
-    def run_search(self, name: str) -> None:
+    def _warm_taxdb(self) -> None:
         """
-        Runs the homology search
+        Primes the OS page cache for the ete3 taxonomy database so the
+        taxonomy fetch after the search starts warm
         """
-        outf = str(name.split(".")[0] + ".tsv")
-        if os.path.exists(f"{os.path.splitext(name)[0]}.tsv") and os.path.getsize(f"{os.path.splitext(name)[0]}.tsv") > 0:
-        #accession_number, accession_bitscore = parse_NCBI(gene)
-            print(f'Diamond file found for {os.path.splitext(name)[0]}')
+        try:
+            conn = sqlite3.connect(os.path.expanduser(self.taxdb))
+            conn.execute("SELECT COUNT(*) FROM species").fetchone()
+            conn.close()
+        except Exception as e:
+            print(f"Warning: Could not warm taxonomy database ({e}).")
+
+    def run_search(self, name: str, combined_file: Path) -> None:
+        """
+        Runs the homology search, writing the results to combined_file
+        """
+        try:
+            st = os.stat(combined_file)
+        except FileNotFoundError:
+            st = None
+        if st is not None and st.st_size > 0:
+            print(f'Diamond file found for {combined_file}')
             return
-        elif self.search == "diamond":
-            myCmd =f'diamond blastp -d {self.dmnd_dbpath} -q {name} --max-target-seqs 250 --outfmt 6 qseqid sseqid evalue bitscore length pident staxids -o {outf}'
-            myCmd = str(myCmd)
-            os.system(myCmd)
+        # Warm the taxonomy SQLite in the background while the search runs
+        threading.Thread(target=self._warm_taxdb, daemon=True).start()
+        ncpu = os.cpu_count() or 1
+        if self.search == "diamond":
+            myCmd = f'diamond blastp -p {ncpu} -d {self.dmnd_dbpath} -q {name} --max-target-seqs 250 --outfmt 6 qseqid sseqid evalue bitscore length pident staxids -o {combined_file}'
+            subprocess.run(shlex.split(myCmd), check=True)
         elif self.search == "mmseqs":
-            myCmd = f'mmseqs easy-search {name} {self.dmnd_dbpath} {outf} --max-seqs 250 --format-output "query,target,evalue,bits,alnlen,pident,taxid'
-            myCmd = str(myCmd)
-            os.system(myCmd)
+            myCmd = f'mmseqs easy-search {name} {self.dmnd_dbpath} {combined_file} --threads {ncpu} --max-seqs 250 --format-output "query,target,evalue,bits,alnlen,pident,taxid"'
+            subprocess.run(shlex.split(myCmd), check=True)
         else:
             print("Error: Search method not recognized")
-            sys.exit()  
+            sys.exit()
 
-    def load_diamond_results(self, combined_file: str , gene: str) -> pd.DataFrame:
+    def load_all_diamond_results(self, combined_file: str) -> Dict[str, List[Tuple[str, float, str]]]:
         """
-        Load the diamond results file into a dataframe and filter for the gene of interest
+        Read the diamond results file once, grouping the first 200
+        (sseqid, bitscore, taxid) hits per query gene. The final taxid is
+        split out of the staxids field here with rpartition so downstream
+        code never re-splits the string. Uses pyarrow's multithreaded CSV
+        reader when available, otherwise a csv.reader stream
         """
-        try:
-            results=pd.read_csv(combined_file, sep='\t', header=None)
-            gene_results = results[results[0] == gene]
-        except pd.errors.EmptyDataError:
-            print(f"Error: No results found for {gene}")
+        hits: Dict[str, List[Tuple[str, float, str]]] = defaultdict(list)
+        if pacsv is not None:
+            try:
+                table = pacsv.read_csv(
+                    str(combined_file),
+                    read_options=pacsv.ReadOptions(column_names=['qseqid', 'sseqid', 'evalue', 'bitscore', 'length', 'pident', 'staxids']),
+                    parse_options=pacsv.ParseOptions(delimiter='\t'),
+                    convert_options=pacsv.ConvertOptions(
+                        include_columns=['qseqid', 'sseqid', 'bitscore', 'staxids'],
+                        column_types={'qseqid': pa.string(), 'sseqid': pa.string(),
+                                      'bitscore': pa.float64(), 'staxids': pa.string()}))
+            except pa.ArrowInvalid:
+                # A zero-hit search writes an empty TSV; fall through to the
+                # "No results found" exit below like the csv.reader path does
+                table = None
+            if table is not None:
+                rows = zip(table['qseqid'].to_pylist(), table['sseqid'].to_pylist(),
+                           table['bitscore'].to_pylist(), table['staxids'].to_pylist())
+                for qseqid, sseqid, bitscore, staxids in rows:
+                    gene_hits = hits[qseqid]
+                    if len(gene_hits) < 200:
+                        gene_hits.append((sseqid, bitscore, (staxids or '').rpartition(';')[2]))
+        else:
+            with open(combined_file, newline='', buffering=1 << 20) as handle:
+                for row in csv.reader(handle, delimiter='\t'):
+                    gene_hits = hits[row[0]]
+                    if len(gene_hits) < 200:
+                        gene_hits.append((row[1], float(row[3]), row[6].rpartition(';')[2]))
+        if not hits:
+            print(f"Error: No results found in {combined_file}")
             sys.exit()
-        return gene_results
+        return dict(hits)
 
     def get_refTax(self, qtaxid: int, tax_level: str) -> int:
         """
@@ -176,13 +281,13 @@ class HGTDetect:
         taxid = filtered_results[6].str.split(';').str[-1].values[0]
         return taxid
 
+    @staticmethod
     def hgt_calc(
-        self, gene: str, max_outgroup_bitscore: float,
+        gene: str, max_outgroup_bitscore: float,
         max_recipient_organism_bitscore: float,outgroup_species_number: int, 
         recipient_species_number: int,HGT: List[List[Any]],
         HGTIndex: float, out_pct: float, tax_level: str, names: Dict[str, str],
-        taxonomy_alignments: Dict[str, Dict[str, str]], bitscore_parameter: float,
-        donor_taxonomy: str
+        bitscore_parameter: float, donor_taxonomy: str
     ) -> List[List[Any]]:
         """
         Calculates the likelihood of a HGT event
@@ -217,89 +322,55 @@ class HGTDetect:
 
     def write_output(self, HGT, tax_level):
         """
-        Writes results of the HGT detection to a file
+        Writes results of the HGT detection to a file. Accepts any iterable
+        (including a lazy executor.map generator) and writes each row as it
+        arrives, so the full result set is never held in memory
         """
-        outfile = open(f"./output_{tax_level}_HGT.tsv", "wt")
-        tsv_writer = csv.writer(outfile, delimiter="\t")
-        column = ['Gene/Protein', 'Bitscore', 'Out_pct',
-                  'HGT index', 'Donor taxonomy']
-        tsv_writer.writerow(column)
-        for HGT_info in HGT :
-            tsv_writer.writerow(HGT_info)
-        outfile.close()
+        with open(f"./output_{tax_level}_HGT.tsv", "wt", buffering=1 << 20, newline='') as outfile:
+            tsv_writer = csv.writer(outfile, delimiter="\t")
+            column = ['Gene/Protein', 'Bitscore', 'Out_pct',
+                      'HGT index', 'Donor taxonomy']
+            tsv_writer.writerow(column)
+            for HGT_info in HGT:
+                if HGT_info is not None:
+                    tsv_writer.writerow(HGT_info)
 
-    def process_gene(self, gene, combined_file, args, taxonomy_alignments, ranks, names, hosttax):
+    @staticmethod
+    def process_gene(gene, gene_hits, args, names, hosttax):
         """
-        Runs the main analysis for each gene, slices the results 
-        for the first 200 hits and returns the HGT results
+        Runs the main analysis for each gene, takes the pre-sliced
+        hits for the gene and returns the HGT results
         """
         try:
-            # Slices first 200 hits and pulls out the accession number, bitscore and taxids
-            gene_results = self.load_diamond_results(combined_file, gene)
-            gene_results = gene_results[:200]
-            gene_results = gene_results.dropna(subset=[6])
-            accession_number = gene_results[1].values
-            accession_bitscore = gene_results[3].values
-            taxids = gene_results[6].str.split(';').str[-1].values
-            accession_to_taxid = dict(zip(accession_number, taxids))
-            #print(f"Debug: Query taxid {args.query_tax}, Taxonomy alignments keys: {list(taxonomy_alignments.keys())[:10]}...")
-            gene_taxlevel = taxonomy_alignments[str(args.query_tax)].get(args.tax_level)
-            #gene_taxlevel = hosttax
-            #if str(args.query_tax) not in taxonomy_alignments:
-            #    print(f"Warning: Query taxid {args.query_tax} not found in taxonomy alignments. Skipping gene {gene}.")
-            #    return None
-            
-            if gene_taxlevel is None:
+            if not gene_hits:
+                print(f"Warning: No results found for {gene}. Skipping.", flush=True)
+                return None
+            query_idx = _taxid_to_idx.get(str(args.query_tax))
+            gene_taxlevel = int(_level_of[query_idx]) if query_idx is not None else -1
+            if gene_taxlevel == -1:
                 print(f"Warning: Tax level {args.tax_level} not found for query taxid {args.query_tax}. Skipping gene {gene}.", flush=True)
                 return None
-            recipient_accession = set()
-            recipient_species = set()
-            outgroup_accession = set()
-            outgroup_species = set()
-            #evalue_dict = {}
-            for accession, taxid in accession_to_taxid.items():
-                if taxid not in taxonomy_alignments:
-                    print(f"Warning: Taxid {taxid} not found in taxonomy alignments. Skipping this accession.", flush=True)
-                    continue
-                taxonomy_alignment = taxonomy_alignments[taxid]
-                if args.tax_level in taxonomy_alignment and taxonomy_alignment[args.tax_level] == gene_taxlevel:
-                    recipient_accession.add(accession)
-                    recipient_species.add(names.get(taxonomy_alignment.get('species'), 'Unknown'))
-                else:
-                    outgroup_accession.add(accession)
-                    outgroup_species.add(names.get(taxonomy_alignment.get('species'), 'Unknown'))
-                #evalue = gene_results[gene_results[1] == accession].iloc[0][2]
-                #evalue_dict[accession] = evalue
-            recipient_accession_bitscore = {acc: bs for acc, bs in zip(accession_number, accession_bitscore) if acc in recipient_accession}
-            outgroup_accession_bitscore = {acc: bs for acc, bs in zip(accession_number, accession_bitscore) if acc in outgroup_accession}
-            max_recipient_organism_bitscore = max(recipient_accession_bitscore.values()) if recipient_accession_bitscore else 0
-            max_outgroup_bitscore = max(outgroup_accession_bitscore.values()) if outgroup_accession_bitscore else 0
-            recipient_species_number = len(recipient_species)
-            outgroup_species_number = len(outgroup_species)
-            #se_minus = 1e-200
+            # Reduce the hits to a sorted, hashable (taxid, bitscore) summary;
+            # bitscores are bucketed to one decimal so equivalent hit sets
+            # share a cache entry
+            hits_tuple = tuple(sorted((taxid, round(bitscore, 1))
+                                      for _, bitscore, taxid in gene_hits if taxid))
+            (max_recipient_organism_bitscore, max_outgroup_bitscore,
+             recipient_species_number, outgroup_species_number,
+             donor_taxid, missing_taxids) = _classify_hits(gene_taxlevel, hits_tuple)
+            if missing_taxids:
+                print(f"Warning: {missing_taxids} hits for {gene} have taxids missing from the taxonomy alignments. Skipping those hits.", flush=True)
             if max_outgroup_bitscore and max_recipient_organism_bitscore:
-                #min_outgroup_key = min(outgroup_accession_bitscore,
-                #                       key=outgroup_accession_bitscore.get)
-                #min_outgroup_evalue = evalue_dict.get(min_outgroup_key, e_minus)
-                #min_ingroup_key = min(recipient_accession_bitscore,
-                #                      key=recipient_accession_bitscore.get)
-                #min_ingroup_evalue = evalue_dict.get(min_ingroup_key, e_minus)
-                #alienindex = format(math.log(min_ingroup_evalue + e_minus, math.e) - math.log(min_outgroup_evalue + e_minus, math.e), '.2f')
-                donor_taxid = None
                 donor_taxonomy = 'Not available'
-                if outgroup_accession_bitscore:
-                    max_outgroup_acc = max(outgroup_accession_bitscore, key=outgroup_accession_bitscore.get)
-                    donor_taxid = accession_to_taxid.get(max_outgroup_acc)
-                    if donor_taxid in taxonomy_alignments:
-                        donor_alignment = taxonomy_alignments[donor_taxid]
-                        if args.tax_level in donor_alignment:
-                            donor_taxonomy = names.get(donor_alignment[args.tax_level], 'Not available')
+                donor_idx = _taxid_to_idx.get(donor_taxid)
+                if donor_idx is not None and _level_of[donor_idx] != -1:
+                    donor_taxonomy = names.get(int(_level_of[donor_idx]), 'Not available')
 
-                hgt_result = self.hgt_calc(
+                hgt_result = HGTDetect.hgt_calc(
                     gene, max_outgroup_bitscore, max_recipient_organism_bitscore,
                     outgroup_species_number, recipient_species_number, [],
                     args.HGTIndex, args.out_pct, args.tax_level,
-                    names, taxonomy_alignments, args.bitscore_parameter, donor_taxonomy
+                    names, args.bitscore_parameter, donor_taxonomy
                 )
                 print("Result for ", gene, "processed", flush= True)
                 return hgt_result[0] if hgt_result else None
@@ -310,56 +381,119 @@ class HGTDetect:
             print(f'Error in process_gene for gene {gene}: {e.__class__.__name__}, Message: {e}', flush=True)
             return None
 
-    @lru_cache(maxsize=None)
-    def get_lineage(self, taxid: int) -> Tuple[int, ...]:
-        """Cached method to get lineage for a taxid."""
-        return tuple(self.ncbi.get_lineage(taxid))
-
-    @lru_cache(maxsize=None)
-    def get_rank(self, taxid: int) -> str:
-        """Cached method to get rank for a taxid."""
-        return self.ncbi.get_rank([taxid])[taxid]
+    def _open_taxdb(self) -> sqlite3.Connection:
+        """
+        Opens a single read-only connection to the ete3 taxonomy database,
+        tuned for bulk memory-mapped reads
+        """
+        conn = sqlite3.connect(os.path.expanduser(self.taxdb), check_same_thread=False)
+        conn.execute("PRAGMA mmap_size=30000000000")
+        conn.execute("PRAGMA cache_size=-200000")
+        conn.execute("PRAGMA query_only=1")
+        return conn
 
-    @lru_cache(maxsize=None)
-    def get_name(self, taxid: int) -> str:
-        """Cached method to get name for a taxid."""
-        return self.ncbi.get_taxid_translator([taxid])[taxid]
+    def _taxonomy_cache_path(self, combined_file: str, query_taxid: int) -> str:
+        """
+        Builds the cache file path for a given diamond results file,
+        versioned by the mtime and size of both the results file and the
+        taxonomy database, so a refreshed taxa.sqlite (e.g. after --update)
+        invalidates the cache
+        """
+        st = os.stat(combined_file)
+        try:
+            taxdb_mtime = os.stat(os.path.expanduser(self.taxdb)).st_mtime_ns
+        except FileNotFoundError:
+            taxdb_mtime = 0
+        cache_dir = os.path.expanduser("~/.cache/flexihgt")
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, f"{st.st_mtime_ns}_{st.st_size}_{taxdb_mtime}_{query_taxid}_{self.tax_level}.pkl")
 
-    def fetch_all_taxonomy_data(self, combined_file: str, query_taxid: int) -> Tuple[Dict[str, Dict[str, int]], Dict[int, str], Dict[int, str]]:
+    def fetch_all_taxonomy_data(self, combined_file: str, query_taxid: int, gene_hits: Dict[str, List[Tuple[str, float, str]]]) -> Tuple[Dict[str, int], 'np.ndarray', List[str], Dict[int, str]]:
         """
-        Fetches all the taxonomy data from the diamond results file
+        Fetches the taxonomy data for the taxids seen in the diamond hits,
+        returning the flattened taxid -> row mapping with the tax_level and
+        species-name columns (the only two ranks the pipeline reads), plus
+        the taxid -> name dict. Cached on disk so repeat runs skip the
+        SQLite lookups
         """
-        df = pd.read_csv(combined_file, sep='\t', header=None, usecols=[6])
-        df[6] = df[6].fillna('').astype(str)
-        unique_taxids: Set[int] = set()
-        for tid in df[6].str.split(';').explode().unique():
+        cache_path = self._taxonomy_cache_path(combined_file, query_taxid)
+        if os.path.exists(cache_path):
             try:
-                if tid and not pd.isna(tid):
-                    unique_taxids.add(int(float(tid)))
-            except ValueError:
-                print(f"Warning: Invalid taxid '{tid}'. Skipping.")
-        
-        unique_taxids.add(query_taxid)
-        lineages: Dict[int, Tuple[int, ...]] = {}
-        for tid in unique_taxids:
-            try:
-                lineages[tid] = self.get_lineage(tid)
+                with open(cache_path, 'rb') as handle:
+                    print(f'Loading cached taxonomy data from {cache_path}')
+                    return pickle.load(handle)
             except Exception as e:
-                print(f"Error fetching lineage for taxid {tid}: {e}")
-        all_taxids: Set[int] = set(tid for lineage in lineages.values() for tid in lineage) | unique_taxids
+                print(f"Warning: Could not load taxonomy cache ({e}). Rebuilding.")
+        # The taxids were already split out during the streaming TSV read,
+        # so no second pass over the file is needed
+        unique_taxids: Set[int] = set()
+        for hits in gene_hits.values():
+            for _, _, tid in hits:
+                try:
+                    if tid:
+                        unique_taxids.add(int(float(tid)))
+                except ValueError:
+                    print(f"Warning: Invalid taxid '{tid}'. Skipping.")
+        unique_taxids.add(query_taxid)
+        # Pull taxid/parent/rank/name straight out of taxa.sqlite in bulk
+        # IN-lists over one connection, then walk the parent pointers in
+        # Python to rebuild lineages — far cheaper than ete3's per-call API
+        parent_of: Dict[int, int] = {}
         ranks: Dict[int, str] = {}
         names: Dict[int, str] = {}
-        for tid in all_taxids:
-            try:
-                ranks[tid] = self.get_rank(tid)
-                names[tid] = self.get_name(tid)
-            except Exception as e:
-                print(f"Error fetching rank or name for taxid {tid}: {e}")
-        taxonomy_alignments: Dict[str, Dict[str, int]] = {}
-        for taxid, lineage in lineages.items():
-            taxonomy_alignments[str(taxid)] = {ranks[tid]: tid for tid in lineage if tid in ranks}
-            taxonomy_alignments[str(taxid)][ranks.get(taxid, 'no rank')] = taxid
-        return taxonomy_alignments, ranks, names
+        conn = self._open_taxdb()
+        frontier: Set[int] = set(unique_taxids)
+        while frontier:
+            batch = list(frontier)
+            frontier = set()
+            for i in range(0, len(batch), 900):
+                chunk = batch[i:i + 900]
+                placeholders = ','.join('?' * len(chunk))
+                rows = conn.execute(
+                    f"SELECT taxid, parent, rank, spname FROM species WHERE taxid IN ({placeholders})",
+                    chunk).fetchall()
+                for taxid, parent, rank, spname in rows:
+                    parent_of[taxid] = parent
+                    ranks[taxid] = rank
+                    names[taxid] = spname
+                    if parent and parent != taxid and parent not in parent_of:
+                        frontier.add(parent)
+        conn.close()
+        # Only the tax_level and species ranks are ever read downstream, so
+        # pick those two taxids out of each lineage walk instead of keeping a
+        # full {rank: taxid} dict per taxid
+        taxid_to_idx: Dict[str, int] = {}
+        level_list: List[int] = []
+        species_of: List[str] = []
+        for tid in unique_taxids:
+            if tid not in parent_of:
+                print(f"Error fetching lineage for taxid {tid}: not found in taxonomy database")
+                continue
+            lvl_id = -1
+            sp_id = -1
+            node = tid
+            while node in parent_of:
+                rank = ranks.get(node)
+                if rank == self.tax_level:
+                    lvl_id = node
+                # Independent check: when tax_level is species the same node
+                # satisfies both lookups
+                if rank == 'species':
+                    sp_id = node
+                parent = parent_of[node]
+                if not parent or parent == node:
+                    break
+                node = parent
+            taxid_to_idx[str(tid)] = len(level_list)
+            level_list.append(lvl_id)
+            species_of.append(names.get(sp_id, 'Unknown'))
+        level_of = np.asarray(level_list, dtype=np.int64)
+        try:
+            with open(cache_path, 'wb') as handle:
+                pickle.dump((taxid_to_idx, level_of, species_of, names), handle, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            print(f"Warning: Could not write taxonomy cache ({e}).")
+        return taxid_to_idx, level_of, species_of, names
 
 
 #if __name__ == "__main__":
@@ -8,6 +8,7 @@ setup(
         "pandas",
         "biopython",
         "ete3",
+        "numpy",
     ],
     entry_points={
         "console_scripts": [